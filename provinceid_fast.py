@@ -1,13 +1,19 @@
 from __future__ import annotations
 
 import argparse
+import heapq
+import importlib.util
 import json
 import time
 from pathlib import Path
 
 import cv2
 import numpy as np
-from PIL import Image
+
+try:
+    import orjson
+except ImportError:  # optional: without orjson the stdlib json encoder is used
+    orjson = None
 
 
 # ----------------------------
@@ -19,6 +25,14 @@ def id_to_rgb(i: int) -> tuple[int, int, int]:
     return (i >> 16) & 255, (i >> 8) & 255, i & 255
 
 
+def rgb_to_id(c: tuple[int, int, int]) -> int:
+    return (int(c[0]) << 16) | (int(c[1]) << 8) | int(c[2])
+
+
+def rgb_to_hex(c: tuple[int, int, int]) -> str:
+    return "#" + bytes(c).hex()
+
+
 def parse_rgb(s: str) -> tuple[int, int, int]:
     """
     Accepts '#RRGGBB' / 'RRGGBB' / 'r,g,b'
@@ -50,6 +64,43 @@ def parse_rgb(s: str) -> tuple[int, int, int]:
     return (r, g, b)
 
 
+def _aligned(shape: tuple[int, ...], dtype, align: int = 64) -> np.ndarray:
+    """
+    Uninitialized C-contiguous array whose data starts on an `align`-byte boundary
+    (NumPy only guarantees 16B), so NumPy/OpenCV SIMD loops run on whole cache lines.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buf = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -buf.ctypes.data % align
+    return buf[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+def rgb_key(rgb: np.ndarray) -> np.ndarray:
+    """
+    rgb: uint8 [H,W,3]
+    returns uint32 [H,W] with key=(r<<16)|(g<<8)|b (same packing as province ids).
+    One padded copy + a uint32 view instead of per-channel compares.
+    """
+    h, w = rgb.shape[:2]
+    bgrx = _aligned((h, w, 4), np.uint8)
+    bgrx[..., :3] = rgb[..., ::-1]
+    bgrx[..., 3] = 0
+    return bgrx.view(np.dtype("<u4")).reshape(h, w)
+
+
+def pack_bgrx(colors: np.ndarray) -> np.ndarray:
+    """
+    colors: uint8 [N,3] RGB
+    returns uint32 [N] whose in-memory bytes are b,g,r,0, so a uint32 image
+    gathered from it views directly as uint8 [H,W,4] BGRX (OpenCV order).
+    """
+    n = colors.shape[0]
+    bgrx = np.zeros((n, 4), dtype=np.uint8)
+    bgrx[:, :3] = colors[:, ::-1]
+    return bgrx.view(np.uint32).reshape(n)
+
+
 def color_match_rgb(rgb: np.ndarray, color: tuple[int, int, int], tol: int) -> np.ndarray:
     """
     rgb: uint8 [H,W,3]
@@ -64,6 +115,74 @@ def color_match_rgb(rgb: np.ndarray, color: tuple[int, int, int], tol: int) -> n
     return (diff[..., 0] <= tol) & (diff[..., 1] <= tol) & (diff[..., 2] <= tol)
 
 
+# ----------------------------
+# Fused paint kernel (optional, numba)
+# ----------------------------
+def numba_paint_kernel():
+    """
+    Returns the fused paint kernel, compiled on first use and cached on disk.
+    numba is imported here rather than at module load, so only --numba pays for it.
+    numba compiles and caches one specialization per argument dtype, so each labels
+    dtype picked after labelling (uint8/uint16/int32) gets its own pixel loop;
+    tol and dilation only change the input masks and need no variant.
+    """
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def paint_border_lut(labels, border, lut32, px_border, out32):
+        """
+        One pass: border pixels take px_border, everything else lut32[label].
+        Water and unclassified pixels carry label 0, which the LUT paints as water.
+        """
+        h, w = labels.shape
+        for y in prange(h):
+            for x in range(w):
+                if border[y, x]:
+                    out32[y, x] = px_border
+                else:
+                    out32[y, x] = lut32[labels[y, x]]
+
+    return paint_border_lut
+
+
+# ----------------------------
+# CUDA path (optional, cupy; imported only for --gpu)
+# ----------------------------
+def masks_gpu(img: np.ndarray, border_color: tuple[int, int, int], land_color: tuple[int, int, int], tol: int):
+    """
+    img: uint8 [H,W,3]
+    returns (device bool [H,W] border, host bool [H,W] land) with land already
+    excluding border. Only land goes back to the host for connected components;
+    border stays on the device for the paint step.
+    """
+    import cupy as cp
+
+    d = cp.asarray(img)
+    if tol <= 0:
+        key = (d[..., 0].astype(cp.uint32) << 16) | (d[..., 1].astype(cp.uint32) << 8) | d[..., 2]
+        border = key == rgb_to_id(border_color)
+        land = key == rgb_to_id(land_color)
+    else:
+        a = d.astype(cp.int16)
+        border = cp.all(cp.abs(a - cp.asarray(border_color, dtype=cp.int16)) <= tol, axis=2)
+        land = cp.all(cp.abs(a - cp.asarray(land_color, dtype=cp.int16)) <= tol, axis=2)
+    land &= ~border
+    return border, cp.asnumpy(land)
+
+
+def paint_gpu(labels: np.ndarray, lut32: np.ndarray, border, px_border) -> np.ndarray:
+    """
+    Device-side LUT gather: labels index lut32, border pixels take px_border.
+    border may be a device or host bool [H,W]; returns host uint32 [H,W].
+    """
+    import cupy as cp
+
+    lut_d = cp.asarray(np.append(lut32, px_border))
+    labels_d = cp.asarray(labels)
+    labels_d[cp.asarray(border)] = lut_d.size - 1
+    return cp.asnumpy(lut_d[labels_d])
+
+
 def build_argparser() -> argparse.ArgumentParser:
     p = argparse.ArgumentParser(description="Mask -> province_id.png + provinces.json (fast OpenCV LUT version)")
     p.add_argument("-i", "--input", default="mask.png", help="Input mask (PNG).")
@@ -86,16 +205,37 @@ def build_argparser() -> argparse.ArgumentParser:
     # Province filtering
     p.add_argument("--min-area", type=int, default=1, help="Minimum province area in px (filter blobs).")
     p.add_argument("--connectivity", type=int, choices=(4, 8), default=4, help="Connected components connectivity.")
+    p.add_argument("--skip-stats", action="store_true",
+                   help="Skip per-province area/center (plain connectedComponents). JSON lists id+color only; "
+                        "requires --min-area 1.")
+
+    # Acceleration
+    p.add_argument("--numba", action="store_true",
+                   help="Paint with a fused multi-threaded numba kernel. Experimental: the numba import and "
+                        "kernel load are counted in the timings and outweighed the savings in single-CPU tests.")
+    p.add_argument("--gpu", action="store_true",
+                   help="Run color matching and LUT paint on a CUDA GPU via cupy (takes precedence over --numba). "
+                        "Experimental and unbenchmarked: moves several full-size arrays between host and device "
+                        "and still labels on the CPU.")
 
     # Output formatting
     p.add_argument("--pretty-json", action="store_true", help="Pretty JSON (indent=2). Bigger + slower.")
+    p.add_argument("--soa-json", action="store_true",
+                   help="Write provinces as parallel arrays {ids,colors,areas,cx,cy} instead of a list of objects.")
     p.add_argument("--png-compress", type=int, default=1,
-                   help="PNG compress_level for Pillow 0..9 (lower=faster, bigger file). Default 1.")
+                   help="PNG compression level 0..9 (lower=faster, bigger file). Default 1.")
     return p
 
 
 def main() -> int:
-    args = build_argparser().parse_args()
+    parser = build_argparser()
+    args = parser.parse_args()
+    if args.skip_stats and args.min_area > 1:
+        parser.error("--min-area filtering needs per-province stats; it cannot be combined with --skip-stats.")
+    if args.numba and not args.gpu and importlib.util.find_spec("numba") is None:
+        parser.error("--numba requires numba (pip install numba).")
+    if args.gpu and importlib.util.find_spec("cupy") is None:
+        parser.error("--gpu requires cupy (pip install cupy-cuda12x or the build matching your CUDA).")
 
     t0 = time.perf_counter()
 
@@ -103,108 +243,175 @@ def main() -> int:
     if not inp.exists():
         raise FileNotFoundError(f"Input not found: {inp}")
 
-    # Read with OpenCV (BGR) then convert to RGB for color matching
-    bgr = cv2.imread(str(inp), cv2.IMREAD_COLOR)
-    if bgr is None:
+    # Decode straight to RGB where OpenCV supports it; otherwise keep BGR and
+    # swap the mask colors instead of paying for a full cvtColor copy.
+    imread_rgb = getattr(cv2, "IMREAD_COLOR_RGB", None)
+    if imread_rgb is not None:
+        img = cv2.imread(str(inp), imread_rgb)
+        mask_border, mask_land = args.border, args.land
+    else:
+        img = cv2.imread(str(inp), cv2.IMREAD_COLOR)
+        mask_border, mask_land = args.border[::-1], args.land[::-1]
+    if img is None:
         raise RuntimeError("cv2.imread failed to read the image.")
-    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-
-    h, w = rgb.shape[:2]
 
-    # Build masks by exact color (with tolerance)
-    border = color_match_rgb(rgb, args.border, args.tol).astype(np.uint8)
-    land = color_match_rgb(rgb, args.land, args.tol).astype(np.uint8)
-    water = color_match_rgb(rgb, args.water, args.tol).astype(np.uint8)
-
-    # Resolve overlaps by priority: border > land > water
-    land = land & (1 - border)
-    water = water & (1 - border) & (1 - land)
+    h, w = img.shape[:2]
+
+    # Mask building through paint is memory-bound: one compare or gather per byte
+    # moved. Masks stay 1-byte bool and are updated in place; the buffers this code
+    # allocates itself (packed key, exact-match masks, painted image) are 64B-aligned.
+
+    # Build masks by exact color (with tolerance). Priority: border > land > water.
+    # Water needs no mask of its own: every non-land pixel gets label 0, which the
+    # LUT paints with the output water color (unclassified pixels included).
+    if args.gpu:
+        # border stays on the device unless dilation needs it on the host
+        border_d, land = masks_gpu(img, mask_border, mask_land, args.tol)
+        border = border_d.get() if args.dilate_borders_1px else None
+    elif args.tol <= 0:
+        # Exact match: pack pixels to 24-bit keys once, then compare against scalar keys.
+        # Distinct keys give disjoint masks, so no overlap resolution pass is needed.
+        key = rgb_key(img)
+        kb, kl = rgb_to_id(mask_border), rgb_to_id(mask_land)
+        border = np.equal(key, kb, out=_aligned((h, w), bool))
+        if kl != kb:
+            land = np.equal(key, kl, out=_aligned((h, w), bool))
+        else:
+            land = np.zeros((h, w), dtype=bool)  # border wins every shared pixel
+        del key
+    else:
+        border = color_match_rgb(img, mask_border, args.tol)
+        land = color_match_rgb(img, mask_land, args.tol)
+        # Tolerance windows can overlap: resolve in place
+        np.logical_and(land, ~border, out=land)
 
     if args.dilate_borders_1px:
-        kernel = np.ones((3, 3), np.uint8)
-        border = cv2.dilate(border, kernel, iterations=1)
-        land = land & (1 - border)
-        water = water & (1 - border) & (1 - land)
-
-    # Components only on land-not-border
-    fillmask = (land & (1 - border)).astype(np.uint8)
+        # Rectangular structuring element lets OpenCV take its separable 1x3 + 3x1 path
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        border = cv2.dilate(
+            border.view(np.uint8), kernel, iterations=1, borderType=cv2.BORDER_ISOLATED
+        ).view(bool)
+        np.logical_and(land, ~border, out=land)
+
+    # Components only on land-not-border (land already excludes borders)
+    fillmask = land.view(np.uint8)
+
+    # connected components (stats are a second pass over labels; skipped when unused)
+    if args.skip_stats:
+        num_labels, labels = cv2.connectedComponents(fillmask, connectivity=args.connectivity)
+        areas = centroids = None
+    else:
+        num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(
+            fillmask, connectivity=args.connectivity
+        )
+        areas = stats[:, cv2.CC_STAT_AREA].astype(np.int32)
 
-    # connected components
-    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(
-        fillmask, connectivity=args.connectivity
-    )
-    areas = stats[:, cv2.CC_STAT_AREA].astype(np.int32)
+    # Narrowest index type for the LUT gather (the paint step is bound by reading labels)
+    if num_labels <= 0xFF:
+        labels = labels.astype(np.uint8, copy=False)
+    elif num_labels <= 0xFFFF:
+        labels = labels.astype(np.uint16, copy=False)
 
     t_cc = time.perf_counter()
 
     # ----------------------------
     # FAST COLORING: LUT approach
     # ----------------------------
-    lut = np.zeros((num_labels, 3), dtype=np.uint8)
+    if num_labels - 1 > 0xFFFFFF:
+        raise ValueError("Province id must be within 0..16777215 (24-bit).")
 
-    # Background label 0: water output color (or black if you want)
-    lut[0] = np.array(args.out_water, dtype=np.uint8)
+    # Labels 1..N-1: province colors, id encoded as (r<<16)|(g<<8)|b
+    ids = np.arange(num_labels, dtype=np.uint32)
+    lut = np.empty((num_labels, 3), dtype=np.uint8)
+    lut[:, 0] = (ids >> 16) & 0xFF
+    lut[:, 1] = (ids >> 8) & 0xFF
+    lut[:, 2] = ids & 0xFF
 
-    # Labels 1..N-1: province colors (or water if filtered)
+    # Background label 0 and filtered labels: water output color
     min_area = int(args.min_area)
-    for lab in range(1, num_labels):
-        if int(areas[lab]) < min_area:
-            lut[lab] = np.array(args.out_water, dtype=np.uint8)
-        else:
-            lut[lab] = np.array(id_to_rgb(lab), dtype=np.uint8)
-
-    # One-shot paint
-    out = lut[labels]  # [H,W,3]
-
-    # Preserve water pixels from original mask (so water stays water even if background areas exist)
-    # This matters if there are "unknown" pixels not classified as land/border/water.
-    out[water.astype(bool)] = args.out_water
+    if areas is None:
+        small = np.zeros(num_labels, dtype=bool)
+    else:
+        small = areas < min_area
+    small[0] = True
+    lut[small] = np.asarray(args.out_water, dtype=np.uint8)
+
+    # One-shot paint: gather whole 4-byte pixels from a packed BGRX LUT
+    lut32 = pack_bgrx(lut)
+    px_border = pack_bgrx(np.array([args.out_border], dtype=np.uint8))[0]
+
+    if args.gpu:
+        # A dilated border is uploaded again; otherwise the device mask is reused
+        out32 = paint_gpu(labels, lut32, border if args.dilate_borders_1px else border_d, px_border)
+    elif args.numba:
+        # Fused kernel: border override and LUT gather in one pass (import/load time lands in Paint)
+        out32 = _aligned((h, w), np.uint32)
+        numba_paint_kernel()(labels, border, lut32, px_border, out32)
+    else:
+        # Borders always override: route them to an extra LUT slot so a single
+        # gather writes every output pixel exactly once
+        lut32 = np.append(lut32, px_border)
+        np.putmask(labels, border, num_labels)
+        out32 = _aligned((h, w), np.uint32)
+        np.take(lut32, labels, out=out32)
 
-    # Borders always override
-    out[border.astype(bool)] = args.out_border
+    out_bgr = np.ascontiguousarray(out32.view(np.uint8).reshape(h, w, 4)[:, :, :3])  # [H,W,3]
 
     t_paint = time.perf_counter()
 
     # ----------------------------
     # Build JSON metadata (fast)
     # ----------------------------
-    provinces = []
-    provinces_reserve = max(0, num_labels - 1)
-    provinces = []
-    provinces_append = provinces.append
-
-    for lab in range(1, num_labels):
-        area = int(areas[lab])
-        if area < min_area:
-            continue
-        r, g, b = map(int, lut[lab])
-        cx, cy = centroids[lab]  # floats
-        provinces_append({
-            "id": int(lab),
-            "color": "#{:02x}{:02x}{:02x}".format(r, g, b),
-            "area_px": area,
-            "center_px": {"x": float(cx), "y": float(cy)}
-        })
-
-    prov_areas = [p["area_px"] for p in provinces]
+    # Kept labels (background 0 and filtered blobs excluded), gathered in bulk
+    keep = ~small
+    idxs = np.nonzero(keep)[0]
+    ids_l = idxs.tolist()  # native ints, converted once
+
+    # Kept labels are painted with their own id, so the color is the id in hex
+    hexes = [f"#{i:06x}" for i in ids_l]
+
+    if areas is None:
+        if args.soa_json:
+            provinces = {"ids": ids_l, "colors": hexes}
+        else:
+            provinces = [{"id": i, "color": c} for i, c in zip(ids_l, hexes)]
+        min_area_px = max_area_px = None
+    else:
+        cx = centroids[idxs, 0].tolist()
+        cy = centroids[idxs, 1].tolist()
+        areas_l = areas[idxs].tolist()
+
+        if args.soa_json:
+            # Parallel arrays: no per-province dicts, far fewer keys to serialize
+            provinces = {"ids": ids_l, "colors": hexes, "areas": areas_l, "cx": cx, "cy": cy}
+        else:
+            provinces = [
+                {"id": i, "color": c, "area_px": a, "center_px": {"x": x, "y": y}}
+                for i, c, a, x, y in zip(ids_l, hexes, areas_l, cx, cy)
+            ]
+
+        kept_areas = areas[keep]
+        min_area_px = int(kept_areas.min()) if kept_areas.size else 0
+        max_area_px = int(kept_areas.max()) if kept_areas.size else 0
+
     meta = {
         "source": str(inp),
         "size": {"w": int(w), "h": int(h)},
-        "provinces_count": int(len(provinces)),
-        "min_area_px": int(min(prov_areas)) if prov_areas else 0,
-        "max_area_px": int(max(prov_areas)) if prov_areas else 0,
+        "provinces_count": len(ids_l),
+        "min_area_px": min_area_px,
+        "max_area_px": max_area_px,
         "connectivity": int(args.connectivity),
         "min_area_filter": int(min_area),
         "dilate_borders_1px": bool(args.dilate_borders_1px),
         "tolerance": int(args.tol),
         "mask_colors": {
-            "border": "#{:02x}{:02x}{:02x}".format(*args.border),
-            "land": "#{:02x}{:02x}{:02x}".format(*args.land),
-            "water": "#{:02x}{:02x}{:02x}".format(*args.water),
+            "border": rgb_to_hex(args.border),
+            "land": rgb_to_hex(args.land),
+            "water": rgb_to_hex(args.water),
         },
         "output_colors": {
-            "border": "#{:02x}{:02x}{:02x}".format(*args.out_border),
-            "water": "#{:02x}{:02x}{:02x}".format(*args.out_water),
+            "border": rgb_to_hex(args.out_border),
+            "water": rgb_to_hex(args.out_water),
         },
         "id_encoding": "id=(r<<16)|(g<<8)|b; r,g,b from province_id.png",
     }
@@ -217,11 +424,22 @@ def main() -> int:
     out_img_path = Path(args.out_img)
     out_json_path = Path(args.out_json)
 
-    # Pillow fast PNG settings
-    Image.fromarray(out).save(out_img_path, format="PNG", optimize=False, compress_level=int(args.png_compress))
+    # OpenCV PNG: RLE strategy suits large flat regions of identical colors.
+    # Always PNG regardless of the output extension (ids must stay lossless).
+    png_params = [
+        cv2.IMWRITE_PNG_COMPRESSION, int(args.png_compress),
+        cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE,
+    ]
+    ok, buf = cv2.imencode(".png", out_bgr, png_params)
+    if not ok:
+        raise RuntimeError("cv2.imencode failed to encode the image.")
+    out_img_path.write_bytes(buf)
 
     payload = {"meta": meta, "provinces": provinces}
-    if args.pretty_json:
+    if orjson is not None:
+        # Serializes straight to UTF-8 bytes in C
+        out_json_path.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2 if args.pretty_json else 0))
+    elif args.pretty_json:
         out_json_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
     else:
         out_json_path.write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
@@ -235,7 +453,8 @@ def main() -> int:
     print(f"Size: {w}x{h}")
     print(f"Labels (incl background): {num_labels}")
     print(f"Provinces (after min-area): {meta['provinces_count']}")
-    print(f"Min area: {meta['min_area_px']} px | Max area: {meta['max_area_px']} px")
+    if areas is not None:
+        print(f"Min area: {meta['min_area_px']} px | Max area: {meta['max_area_px']} px")
     print(f"Outputs: {out_img_path}, {out_json_path}")
     print()
     print("Timings:")
@@ -247,10 +466,13 @@ def main() -> int:
     # ----------------------------
     # Top-10 debug
     # ----------------------------
-    top_10 = sorted(provinces, key=lambda p: p["area_px"], reverse=True)[:10]
+    if areas is None:
+        return 0
+    # (id, area, cx, cy) rows, independent of the JSON layout
+    top_10 = heapq.nlargest(10, zip(ids_l, areas_l, cx, cy), key=lambda r: r[1])
     print("\n--- TOP 10 PROVINCES BY AREA ---")
-    for i, p in enumerate(top_10, 1):
-        print(f"{i:>2}. ID: {p['id']:<6} | Area: {p['area_px']:>8} px | Center: ({int(p['center_px']['x'])}, {int(p['center_px']['y'])})")
+    for i, (pid, area, x, y) in enumerate(top_10, 1):
+        print(f"{i:>2}. ID: {pid:<6} | Area: {area:>8} px | Center: ({int(x)}, {int(y)})")
     return 0
 
 